@@ -214,7 +214,7 @@ class WidgetCommunicationChannels(QObject):
     video_frame_time_signal = pyqtSignal(int)
     video_image_resolution_signal = pyqtSignal(int, int)
     video_acq_time_signal = pyqtSignal(QDateTime)
-    fly_coord_pos_signal = pyqtSignal(list)
+    fly_coord_pos_signal = pyqtSignal(np.ndarray)
     tracker_running_signal = pyqtSignal(bool)
     refresh_display_signal = pyqtSignal()
     status_updated_signal = pyqtSignal()
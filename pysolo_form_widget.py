@@ -1,10 +1,11 @@
 #!/usr/bin/env python
+import os
 import re
 import threading
 from functools import partial
 from pathlib import Path
 
-import os
+import numpy as np
 from PyQt5.QtCore import pyqtSlot, Qt, QDateTime, QObject, QTimer, QTime, pyqtSignal
 from PyQt5.QtWidgets import (QWidget, QPushButton, QHBoxLayout,
                              QLabel, QLineEdit, QGridLayout, QFileDialog, QVBoxLayout, QSpinBox, QComboBox,
@@ -691,7 +692,8 @@ class TrackerWidget(QWidget):
             if not self._communication_channels.lock.signalsBlocked() and frame_image is not None:
                 if self._refresh_interval > 0 and frame_index % self._refresh_interval == 0:
                     self._communication_channels.video_frame_signal.emit(frame_index, int(frame_time_in_seconds), frame_image)
-                    self._communication_channels.fly_coord_pos_signal.emit(fly_coords)
+                    self._communication_channels.fly_coord_pos_signal.emit(
+                        np.asarray(fly_coords, dtype=np.float32).reshape((-1, 2)))
                 if monitored_areas is not None and self._show_rois_during_tracking.checkState():
                     self._communication_channels.all_monitored_areas_rois_signal.emit(monitored_areas, CrossingBeamType.based_on_roi_coord)
 
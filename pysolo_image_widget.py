@@ -4,15 +4,29 @@ from datetime import timedelta
 import cv2
 import numpy as np
 
+from collections import deque
 from functools import partial
 
-from PyQt5.QtCore import pyqtSlot, Qt, QThread, QObject, pyqtSignal, QRect, QDateTime
+from PyQt5.QtCore import pyqtSlot, Qt, QThread, QObject, pyqtSignal, QRect, QDateTime, QMutex, QTimer
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtWidgets import (QWidget, QLabel, QVBoxLayout, QSlider, QHBoxLayout, QGridLayout, QSpacerItem, QSizePolicy)
 
 from pysolo_video import MovieFile, MonitoredArea, CrossingBeamType
 
 
+def _cross_segments(coords, delta_x, delta_y):
+    """
+    Computes the segments of a cross centered at each of the given coordinates
+    :param coords: array of shape (n, 2) with the (x, y) coordinates
+    :param delta_x: half width of the cross
+    :param delta_y: half height of the cross
+    :return: int32 array of shape (2 * n, 2, 2) - a vertical and a horizontal segment for each cross
+    """
+    cross_offsets = np.array([[[0, -delta_y], [0, delta_y]],
+                              [[-delta_x, 0], [delta_x, 0]]])
+    return (coords[:, np.newaxis, np.newaxis, :] + cross_offsets).reshape((-1, 2, 2)).astype(np.int32)
+
+
 class ImageWidget(QWidget):
 
     def __init__(self, communication_channels, image_width=640, image_height=640):
@@ -25,11 +39,26 @@ class ImageWidget(QWidget):
         self._image_scale = None
         self._movie_acq_time = None
         self._ratio = image_width / image_height
+        # display geometry derived from the source frame size - see _update_display_size
+        self._src_size = None
+        self._dst_size = None
+        self._overlay_sx = None
+        self._overlay_sy = None
+        self._fly_cross_delta = None
+        # buffer for the resized (BGR) frame - only used by the update worker, see _update_image_pixels
+        self._resized_frame = None
+        # RGB buffers returned by the GUI thread once they are displayed so the worker can reuse them
+        self._rgb_buffers = deque()
+        # cached rasterized ROIs - see _get_roi_overlay
+        self._roi_overlay = None
         self._init_ui()
         self._init_event_handlers()
         # initialize image refresher
         self._image_update_thread = QThread()
         self._image_update_worker = ImageWidgetUpdateWorker(self._update_image_pixels, self._communication_channels)
+        self._image_update_worker.moveToThread(self._image_update_thread)
+        # the worker only prepares the pixels - the pixmap is always set on the GUI thread
+        self._image_update_worker.finished.connect(self._set_image_pixels, Qt.QueuedConnection)
         self._image_update_thread.start()
 
     def _init_ui(self):
@@ -54,6 +83,11 @@ class ImageWidget(QWidget):
         frame_value_layout.addWidget(self._current_frame_acq_value_lbl, 1, 1)
 
         self._frame_sld = QSlider(Qt.Horizontal, self)
+        # slider moves are coalesced so that dragging doesn't seek and decode a frame for every position
+        self._pending_frame_sld_pos = None
+        self._frame_sld_timer = QTimer(self)
+        self._frame_sld_timer.setSingleShot(True)
+        self._frame_sld_timer.setInterval(30)
         frame_value_layout.addWidget(self._frame_sld, 2, 0, 1, 2)
         vertical_spacer = QSpacerItem(10, 1, QSizePolicy.Minimum, QSizePolicy.Expanding)
         frame_value_layout.addItem(vertical_spacer, 3, 0, 1, 2)
@@ -64,7 +98,8 @@ class ImageWidget(QWidget):
         self.setLayout(layout)
 
     def _init_event_handlers(self):
-        self._frame_sld.valueChanged[int].connect(self._update_frame_sld_pos)
+        self._frame_sld.valueChanged[int].connect(self._schedule_frame_sld_pos)
+        self._frame_sld_timer.timeout.connect(self._apply_pending_frame_sld_pos)
         self._communication_channels.video_frame_signal.connect(self._update_frame)
         self._communication_channels.video_frame_time_signal.connect(self._update_frame_sld_pos)
         self._communication_channels.video_loaded_signal.connect(self._set_movie)
@@ -77,8 +112,23 @@ class ImageWidget(QWidget):
         self._communication_channels.video_image_resolution_signal.connect(self._set_movie_resolution)
         self._communication_channels.video_acq_time_signal.connect(self._set_movie_acq_time)
 
+    @pyqtSlot(int)
+    def _schedule_frame_sld_pos(self, value):
+        self._pending_frame_sld_pos = value
+        if not self._frame_sld_timer.isActive():
+            self._frame_sld_timer.start()
+
+    def _apply_pending_frame_sld_pos(self):
+        value = self._pending_frame_sld_pos
+        self._pending_frame_sld_pos = None
+        if value is not None and self._movie_file is not None:
+            self._update_frame_sld_pos(value)
+
     def _update_frame_sld_pos(self, value, frame_index_param=None, update_frame_image=True):
+        # the frame is updated below so the slider must not schedule another update
+        self._frame_sld.blockSignals(True)
         self._frame_sld.setValue(int(value))
+        self._frame_sld.blockSignals(False)
 
         # display frame index
         if frame_index_param is not None:
@@ -119,6 +169,7 @@ class ImageWidget(QWidget):
             self._frame_sld.setMinimum(0)
             self._frame_sld.setMaximum(int(self._movie_file.get_end_time_in_seconds()))
             self._image_scale = self._movie_file.get_scale()
+            self._update_display_size(*self._movie_file.get_size())
             self._update_frame_sld_pos(0, update_frame_image=True)
         else:
             self._movie_file = None
@@ -131,30 +182,92 @@ class ImageWidget(QWidget):
         self._communication_channels.mask_on_signal.emit(False)
         self._update_image_pixels_async(self._image_frame)
 
-    def _update_image_pixels(self, image):
-        color_swapped_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        vert_scalef = self._image_height / image.shape[0]
-        horz_scalef = self._image_width / image.shape[1]
-        image_ratio = image.shape[1] / image.shape[0]
-        color_swapped_image = cv2.resize(color_swapped_image,
-                                         (int(color_swapped_image.shape[1] * horz_scalef * self._ratio),
-                                          int(color_swapped_image.shape[0] * vert_scalef * self._ratio / image_ratio)),
-                                         interpolation=cv2.INTER_AREA)
-        image = QImage(color_swapped_image,
-                             color_swapped_image.shape[1],
-                             color_swapped_image.shape[0],
-                             QImage.Format_RGB888)
-        self._video_frame.setPixmap(QPixmap.fromImage(image))
+    def _update_display_size(self, frame_width, frame_height):
+        """
+        Compute the size of the displayed image and the source to display scale factors.
+        These only depend on the source frame size and on the widget size so they are
+        computed once when the movie or its resolution changes instead of for every frame.
+        :param frame_width: source frame width
+        :param frame_height: source frame height
+        :return:
+        """
+        if not frame_width or not frame_height:
+            self._src_size = None
+            self._dst_size = None
+            self._overlay_sx = None
+            self._overlay_sy = None
+            self._fly_cross_delta = None
+            return
+        vert_scalef = self._image_height / frame_height
+        horz_scalef = self._image_width / frame_width
+        image_ratio = frame_width / frame_height
+        dst_w = int(frame_width * horz_scalef * self._ratio)
+        dst_h = int(frame_height * vert_scalef * self._ratio / image_ratio)
+        self._src_size = (frame_width, frame_height)
+        self._dst_size = (dst_w, dst_h)
+        self._overlay_sx = dst_w / frame_width
+        self._overlay_sy = dst_h / frame_height
+        # half size of the cross drawn at each fly position in source frame coordinates
+        scalef = self._image_height / frame_width
+        self._fly_cross_delta = (3 / scalef / self._ratio, 3 / scalef / self._ratio * frame_height / frame_width)
+
+    def _update_image_pixels(self, image, dst_size, roi_overlay=None):
+        """
+        Runs on the update worker thread so it only uses the display size it was given
+        and not the display geometry of the widget, which the GUI thread may be changing.
+        """
+        rgb_image = self._get_rgb_buffer(dst_size)
+        resized_frame = self._resized_frame
+        if resized_frame is None or resized_frame.shape[:2] != (dst_size[1], dst_size[0]):
+            resized_frame = np.empty((dst_size[1], dst_size[0], 3), dtype=np.uint8)
+            self._resized_frame = resized_frame
+        # resize first so that the color swap only touches the (smaller) displayed image
+        resized_image = cv2.resize(image, dst_size, dst=resized_frame, interpolation=cv2.INTER_LINEAR)
+        rgb_image = cv2.cvtColor(resized_image, cv2.COLOR_BGR2RGB, dst=rgb_image)
+        if roi_overlay is not None:
+            overlay, overlay_mask = roi_overlay
+            if overlay.shape == rgb_image.shape:
+                np.copyto(rgb_image, overlay, where=overlay_mask)
+        return rgb_image
+
+    def _get_rgb_buffer(self, dst_size):
+        try:
+            rgb_image = self._rgb_buffers.pop()
+        except IndexError:
+            rgb_image = None
+        if rgb_image is None or rgb_image.shape[:2] != (dst_size[1], dst_size[0]):
+            rgb_image = np.empty((dst_size[1], dst_size[0], 3), dtype=np.uint8)
+        return rgb_image
 
-    def _update_image_pixels_async(self, image):
-        self._image_update_worker.moveToThread(self._image_update_thread)
-        self._image_update_worker.start.emit(image)
+    @pyqtSlot(np.ndarray)
+    def _set_image_pixels(self, rgb_image):
+        # QImage assumes 32-bit aligned rows unless told otherwise, so always pass the actual row stride
+        rgb_image = np.ascontiguousarray(rgb_image)
+        image = QImage(rgb_image,
+                       rgb_image.shape[1],
+                       rgb_image.shape[0],
+                       rgb_image.strides[0],
+                       QImage.Format_RGB888)
+        self._video_frame.setPixmap(QPixmap.fromImage(image))
+        # the pixmap has its own copy of the pixels so the buffer can be reused
+        if len(self._rgb_buffers) < 2:
+            self._rgb_buffers.append(rgb_image)
+
+    def _update_image_pixels_async(self, image, roi_overlay=None):
+        if image is None:
+            return  # no frame to display yet
+        # the display size is computed here on the GUI thread and it is sent to the worker with the image
+        if self._src_size != (image.shape[1], image.shape[0]):
+            self._update_display_size(image.shape[1], image.shape[0])
+        self._image_update_worker.submit(image, self._dst_size, roi_overlay)
 
     @pyqtSlot(int, int)
     def _set_movie_resolution(self, width, height):
         if self._movie_file is not None:
             self._movie_file.set_resolution(width, height)
             self._image_scale = self._movie_file.get_scale()
+            self._update_display_size(*self._movie_file.get_size())
+            self._roi_overlay = None
 
     @pyqtSlot(QDateTime)
     def _set_movie_acq_time(self, acq_time):
@@ -174,52 +287,69 @@ class ImageWidget(QWidget):
     def _display_rois(self, monitored_area, crossing_line):
         if self._movie_file is None:
             return  # do nothing
-        roi_image = self._image_frame.copy()
         if monitored_area:
-            color = (128, 255, 0)
-            line_thickness = 2
-            for roi_index, roi in enumerate(monitored_area.ROIS):
-                if monitored_area.is_roi_trackable(roi_index):
-                    roi_array = np.array(monitored_area.roi_to_poly(roi, self._image_scale))
-                    cv2.polylines(roi_image, [roi_array], isClosed=True, color=color, thickness=line_thickness)
-                    if CrossingBeamType.is_crossing_beam_needed(monitored_area.get_track_type(), crossing_line):
-                        mid1, mid2 = monitored_area.get_midline(roi, self._image_scale, conv=int, midline_type=crossing_line)
-                        cv2.line(roi_image, mid1, mid2, color=color, thickness=line_thickness)
+            roi_overlay = self._get_roi_overlay([monitored_area], crossing_line)
             self._communication_channels.mask_on_signal.emit(True)
         else:
+            roi_overlay = None
             self._communication_channels.mask_on_signal.emit(False)
 
-        self._update_image_pixels_async(roi_image)
+        self._update_image_pixels_async(self._image_frame, roi_overlay)
 
     @pyqtSlot(list, CrossingBeamType)
     def _display_all_monitored_areas_rois(self, monitored_areas, crossing_line):
         if self._movie_file is None:
             return  # do nothing
-        roi_image = self._image_frame.copy()
-        polys_list = []
-        point_pairs_list = []
-        color = (128, 255, 0)
-        line_thickness = 2
-
-        for monitored_area in monitored_areas:
-            for roi_index, roi in enumerate(monitored_area.ROIS):
-                if monitored_area.is_roi_trackable(roi_index):
-                    roi_array = np.array(monitored_area.roi_to_poly(roi, self._image_scale))
-                    polys_list.append(roi_array)
-                    if CrossingBeamType.is_crossing_beam_needed(monitored_area.get_track_type(), crossing_line):
-                        mid1, mid2 = monitored_area.get_midline(roi, self._image_scale, conv=int, midline_type=crossing_line)
-                        point_pairs_list.append((mid1, mid2))
-
-        self._draw_lines_on_image(roi_image, polys_list, point_pairs_list, color, line_thickness, 2)
+        roi_overlay = self._get_roi_overlay(monitored_areas, crossing_line)
 
         self._communication_channels.mask_on_signal.emit(True)
-        self._update_image_pixels_async(roi_image)
+        self._update_image_pixels_async(self._image_frame, roi_overlay)
 
-    @pyqtSlot(list)
+    def _get_roi_overlay(self, monitored_areas, crossing_line):
+        """
+        Rasterizes the ROIs of the given monitored areas at the displayed image size.
+        The overlay is drawn in RGB and it is composited by the update worker after the frame is resized,
+        so the source frame is neither copied nor modified. The overlay is reused for as long as
+        the monitored areas, the crossing line, the scale and the displayed image size do not change.
+        :param monitored_areas: list of monitored areas
+        :param crossing_line: crossing line type
+        :return: the overlay image and the mask of the overlay pixels
+        """
+        frame_height, frame_width = self._image_frame.shape[:2]
+        if self._src_size != (frame_width, frame_height):
+            self._update_display_size(frame_width, frame_height)
+        # monitored areas don't define equality so they are compared by identity; the key also keeps them
+        # referenced so their ids cannot be reused while the overlay is cached
+        overlay_key = (tuple(monitored_areas), crossing_line, self._image_scale, self._dst_size)
+        if self._roi_overlay is None or self._roi_overlay[0] != overlay_key:
+            polys_list = []
+            point_pairs_list = []
+            color = (128, 255, 0)
+            line_thickness = 2
+            image_scale = self._image_scale or (1, 1)
+            overlay_scale = (image_scale[0] * self._overlay_sx, image_scale[1] * self._overlay_sy)
+
+            for monitored_area in monitored_areas:
+                polys_list.append(monitored_area.get_trackable_rois_polys(overlay_scale))
+                if CrossingBeamType.is_crossing_beam_needed(monitored_area.get_track_type(), crossing_line):
+                    point_pairs_list.append(monitored_area.get_trackable_rois_midlines(overlay_scale,
+                                                                                      midline_type=crossing_line))
+            polys_list = np.concatenate(polys_list) if polys_list else polys_list
+            point_pairs_list = np.concatenate(point_pairs_list) if point_pairs_list else point_pairs_list
+
+            overlay = np.zeros((self._dst_size[1], self._dst_size[0], 3), dtype=np.uint8)
+            self._draw_lines_on_image(overlay, polys_list, point_pairs_list, color, line_thickness, cv2.LINE_8)
+            overlay = cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB)
+            overlay_mask = overlay.any(axis=2, keepdims=True)
+            self._roi_overlay = (overlay_key, (overlay, overlay_mask))
+
+        return self._roi_overlay[1]
+
+    @pyqtSlot(np.ndarray)
     def _draw_fly_pos(self, fly_coords):
         """
-        Draws a cross at each position from the fly_coords list
-        :param fly_coords: list of fly coordinates
+        Draws a cross at each position from the fly_coords array
+        :param fly_coords: array of shape (n, 2) with the fly coordinates
         :return:
         """
         if self._image_frame is not None:
@@ -228,46 +358,69 @@ class ImageWidget(QWidget):
             point_pairs_list = []
             color = (255, 10, 0)
             line_thickness = 2
-            line_type = cv2.LINE_AA
-
-            scalef = self._image_height / image_frame.shape[1]
-            image_ratio = image_frame.shape[0] / image_frame.shape[1]
-            delta_x = 3 / scalef / self._ratio
-            delta_y = 3 / scalef / self._ratio * image_ratio
-
-            for fly_coord in fly_coords:
-                # draw the position of the fly
-                x = fly_coord[0]
-                y = fly_coord[1]
-                a = (int(x), int(y - delta_y))
-                b = (int(x), int(y + delta_y))
-                c = (int(x - delta_x), int(y))
-                d = (int(x + delta_x), int(y))
-                point_pairs_list.append((a, b))
-                point_pairs_list.append((c, d))
+            line_type = cv2.LINE_8
+
+            if self._src_size != (image_frame.shape[1], image_frame.shape[0]):
+                self._update_display_size(image_frame.shape[1], image_frame.shape[0])
+
+            if len(fly_coords) > 0:
+                # draw the position of the flies - a vertical and a horizontal segment per fly
+                point_pairs_list = _cross_segments(fly_coords, *self._fly_cross_delta)
 
             self._draw_lines_on_image(image_frame, polys_list, point_pairs_list, color, line_thickness, line_type)
             self._update_image_pixels_async(image_frame)
 
     def _draw_lines_on_image(self, image, polys_list, point_pairs_list, color, thickness, line_type):
-        for poly in polys_list:
-            cv2.polylines(image, [poly], isClosed=True, color=color, thickness=thickness, lineType=line_type)
-        for point_pair in point_pairs_list:
-            cv2.line(image, point_pair[0], point_pair[1], color=color, thickness=thickness, lineType=line_type)
+        # draw all polygons and then all segments with a single opencv call each
+        if len(polys_list) > 0:
+            cv2.polylines(image, polys_list, isClosed=True, color=color, thickness=thickness, lineType=line_type)
+        if len(point_pairs_list) > 0:
+            cv2.polylines(image, np.asarray(point_pairs_list, dtype=np.int32), isClosed=False,
+                          color=color, thickness=thickness, lineType=line_type)
 
 
 class ImageWidgetUpdateWorker(QObject):
 
-    start = pyqtSignal(np.ndarray)
+    start = pyqtSignal()
+    finished = pyqtSignal(np.ndarray)
 
     def __init__(self, function, communication_channels):
         super(ImageWidgetUpdateWorker, self).__init__()
         self._function = function
         self._communication_channels = communication_channels
+        # the most recent image submitted for display - only the worker takes it out
+        self._pending_image = None
+        self._pending_image_mutex = QMutex()
         self.start.connect(self.run)
 
-    @pyqtSlot(np.ndarray)
-    def run(self, image):
+    def submit(self, image, dst_size, roi_overlay=None):
+        """
+        Schedules the image for display. If the worker has not picked up the previously
+        submitted image yet, that image is replaced and it will never be displayed.
+        The worker is woken up only if there was no pending image, so at most one
+        wake up is ever queued no matter how fast the images are submitted.
+        :param image: image to display
+        :param dst_size: size of the displayed image
+        :param roi_overlay: optional ROI overlay composited on the displayed image
+        :return:
+        """
+        self._pending_image_mutex.lock()
+        wake_up_worker = self._pending_image is None
+        self._pending_image = (image, dst_size, roi_overlay)
+        self._pending_image_mutex.unlock()
+        if wake_up_worker:
+            self.start.emit()
+
+    @pyqtSlot()
+    def run(self):
+        self._pending_image_mutex.lock()
+        pending_image = self._pending_image
+        self._pending_image = None
+        self._pending_image_mutex.unlock()
+        if pending_image is None:
+            return  # the image was already displayed by a previous run
+        image, dst_size, roi_overlay = pending_image
         self._communication_channels.lock.blockSignals(True)
-        self._function(image)
+        rgb_image = self._function(image, dst_size, roi_overlay)
         self._communication_channels.lock.blockSignals(False)
+        self.finished.emit(rgb_image)
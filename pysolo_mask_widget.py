@@ -1,20 +1,41 @@
 #!/usr/bin/env python
 import os
-from PyQt5.QtCore import QRegExp
+from collections import OrderedDict
+from functools import partial
+from PyQt5.QtCore import Qt, QObject, QRegExp, QTimer, pyqtSignal
 from PyQt5.QtGui import QRegExpValidator
 from PyQt5.QtWidgets import (QPushButton, QLabel, QComboBox, QDialog, QGridLayout, QSpinBox, QLineEdit,
                              QFileDialog, QCheckBox)
 
-from pysolo_maskmaker import create_mask, get_mask_params, get_mask_params_from_rois
+from pysolo_maskmaker import MaskParams, create_mask, get_mask_params, get_mask_params_from_rois
 from pysolo_video import MonitoredArea, CrossingBeamType
 
 
+# a mask parameter is a signed number with at most 2 decimals
+_MASK_PARAM_REGEX = QRegExp('(-)?[0-9]+\\.?[0-9]{,2}')
+_mask_param_validator = None
+# mask parameters read from the mask files keyed by the file path - see _read_mask_params
+_mask_files_params = OrderedDict()
+_MAX_CACHED_MASK_FILES = 16
+
+
+def _get_mask_param_validator():
+    # the validator can only be created once the application exists so it is created on first use
+    global _mask_param_validator
+    if _mask_param_validator is None:
+        _mask_param_validator = QRegExpValidator(_MASK_PARAM_REGEX)
+    return _mask_param_validator
+
+
 class CreateMaskDlgWidget(QDialog):
 
     def __init__(self, communication_channels):
         super(CreateMaskDlgWidget, self).__init__()
         self._communication_channels = communication_channels
         self.setWindowTitle('MAsk Editor')
+        self._last_mask_key = None
+        self._last_mask = None
+        self._mask_draw_scheduled = False
         self._init_ui()
 
     def _init_ui(self):
@@ -53,69 +74,42 @@ class CreateMaskDlgWidget(QDialog):
         layout.addWidget(self._cols_box, current_widget_row, 3, 1, 3)
         current_widget_row += 1
 
-        reg_ex = QRegExp('(-)?[0-9]+.?[0-9]{,2}')
-        mask_param_validator = QRegExpValidator(reg_ex)
-
-        x1_lbl = QLabel('x1')
-        self.x1_txt = QLineEdit()
-        self.x1_txt.setValidator(mask_param_validator)
-        x_span_lbl = QLabel('x span')
-        self.x_span_txt = QLineEdit()
-        self.x_span_txt.setValidator(mask_param_validator)
-        x_gap_lbl = QLabel('x gap')
-        self.x_gap_txt = QLineEdit()
-        self.x_gap_txt.setValidator(mask_param_validator)
-        x_tilt_lbl = QLabel('x tilt')
-        self.x_tilt_txt = QLineEdit()
-        self.x_tilt_txt.setValidator(mask_param_validator)
-
-        y1_lbl = QLabel('y1')
-        self.y1_txt = QLineEdit()
-        self.y1_txt.setValidator(mask_param_validator)
-        y_len_lbl = QLabel('y span')
-        self.y_len_txt = QLineEdit()
-        self.y_len_txt.setValidator(mask_param_validator)
-        y_sep_lbl = QLabel('y gap')
-        self.y_sep_txt = QLineEdit()
-        self.y_sep_txt.setValidator(mask_param_validator)
-        y_tilt_lbl = QLabel('y tilt')
-        self.y_tilt_txt = QLineEdit()
-        self.y_tilt_txt.setValidator(mask_param_validator)
-
-        layout.addWidget(x1_lbl, current_widget_row, 0, 1, 3)
-        layout.addWidget(y1_lbl, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
-        layout.addWidget(self.x1_txt, current_widget_row, 0, 1, 3)
-        layout.addWidget(self.y1_txt, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
-
-        layout.addWidget(x_span_lbl, current_widget_row, 0, 1, 3)
-        layout.addWidget(y_len_lbl, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
-        layout.addWidget(self.x_span_txt, current_widget_row, 0, 1, 3)
-        layout.addWidget(self.y_len_txt, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
-
-        layout.addWidget(x_gap_lbl, current_widget_row, 0, 1, 3)
-        layout.addWidget(y_sep_lbl, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
-        layout.addWidget(self.x_gap_txt, current_widget_row, 0, 1, 3)
-        layout.addWidget(self.y_sep_txt, current_widget_row, 3, 1, 3)
-        current_widget_row += 1
+        mask_param_validator = _get_mask_param_validator()
+        # every row has an x parameter on the left and the corresponding y parameter on the right
+        mask_params_layout = (
+            (('x1', 'x1'), ('y1', 'y1')),
+            (('x_span', 'x span'), ('y_len', 'y span')),
+            (('x_gap', 'x gap'), ('y_sep', 'y gap')),
+            (('x_tilt', 'x tilt'), ('y_tilt', 'y tilt')),
+        )
+        self._mask_param_txts = {}
+        # the parsed field values - these are updated as soon as a field changes
+        self._mask_param_values = {}
+        for mask_params_row in mask_params_layout:
+            for col, (mask_param_name, mask_param_label) in enumerate(mask_params_row):
+                mask_param_txt = QLineEdit()
+                mask_param_txt.setValidator(mask_param_validator)
+                self._mask_param_txts[mask_param_name] = mask_param_txt
+                self._mask_param_values[mask_param_name] = 0
+                layout.addWidget(QLabel(mask_param_label), current_widget_row, col * 3, 1, 3)
+                layout.addWidget(mask_param_txt, current_widget_row + 1, col * 3, 1, 3)
+            current_widget_row += 2
 
-        layout.addWidget(x_tilt_lbl, current_widget_row, 0, 1, 3)
-        layout.addWidget(y_tilt_lbl, current_widget_row, 3, 1, 3)
         current_widget_row += 1
-        layout.addWidget(self.x_tilt_txt, current_widget_row, 0, 1, 3)
-        layout.addWidget(self.y_tilt_txt, current_widget_row, 3, 1, 3)
-
-        current_widget_row += 2
 
         self._overlay_check = QCheckBox()
         self._overlay_check.setChecked(True)
+        self._overlay_enabled = True
+
+        # without live preview the overlay is only updated when a field loses focus or Return is pressed
+        self._live_preview_check = QCheckBox()
+        self._live_preview_check.setChecked(False)
+        self._live_preview = False
 
         layout.addWidget(self._overlay_check, current_widget_row, 0)
         layout.addWidget(QLabel('Overlay mask'), current_widget_row, 1)
+        layout.addWidget(self._live_preview_check, current_widget_row, 3)
+        layout.addWidget(QLabel('Live preview'), current_widget_row, 4)
 
         current_widget_row += 2
 
@@ -127,21 +121,22 @@ class CreateMaskDlgWidget(QDialog):
         layout.addWidget(load_btn, current_widget_row, 2, 1, 2)
         layout.addWidget(save_btn, current_widget_row, 4, 1, 2)
 
-        self._update_mask_params()
+        # while the mask fields are edited the overlay is updated at most every 100ms
+        self._overlay_throttler = SignalThrottler(100, self)
+        self._overlay_throttler.triggered.connect(self._update_mask_overlay)
+
+        # the initial mask is only created and displayed once the dialog is shown
+        QTimer.singleShot(0, self._update_mask_params)
         self._area_location_choice.currentIndexChanged.connect(self._update_mask_params)
 
         self._crossline_choice.currentTextChanged.connect(self._update_mask_overlay)
-        self._rows_box.valueChanged.connect(self._update_mask_overlay)
-        self._cols_box.valueChanged.connect(self._update_mask_overlay)
-        self.x1_txt.textChanged.connect(self._update_mask_overlay)
-        self.x_span_txt.textChanged.connect(self._update_mask_overlay)
-        self.x_gap_txt.textChanged.connect(self._update_mask_overlay)
-        self.x_tilt_txt.textChanged.connect(self._update_mask_overlay)
-        self.y1_txt.textChanged.connect(self._update_mask_overlay)
-        self.y_len_txt.textChanged.connect(self._update_mask_overlay)
-        self.y_sep_txt.textChanged.connect(self._update_mask_overlay)
-        self.y_tilt_txt.textChanged.connect(self._update_mask_overlay)
-        self._overlay_check.stateChanged.connect(self._update_mask_overlay)
+        self._rows_box.valueChanged.connect(self._schedule_mask_overlay_update)
+        self._cols_box.valueChanged.connect(self._schedule_mask_overlay_update)
+        for mask_param_name, mask_param_txt in self._mask_param_txts.items():
+            mask_param_txt.textChanged.connect(partial(self._update_mask_param_value, mask_param_name))
+            mask_param_txt.editingFinished.connect(self._finish_mask_param_edit)
+        self._overlay_check.stateChanged.connect(self._toggle_mask_overlay)
+        self._live_preview_check.stateChanged.connect(self._toggle_live_preview)
 
         cancel_btn.clicked.connect(self.close)
         load_btn.clicked.connect(self._load_mask)
@@ -154,15 +149,14 @@ class CreateMaskDlgWidget(QDialog):
         self._update_mask_params_values(mask_params)
 
     def _update_mask_params_values(self, mask_params):
-        self.x1_txt.setText(str(mask_params['x1']))
-        self.x_span_txt.setText(str(mask_params['x_span']))
-        self.x_gap_txt.setText(str(mask_params['x_gap']))
-        self.x_tilt_txt.setText(str(mask_params['x_tilt']))
-
-        self.y1_txt.setText(str(mask_params['y1']))
-        self.y_len_txt.setText(str(mask_params['y_len']))
-        self.y_sep_txt.setText(str(mask_params['y_sep']))
-        self.y_tilt_txt.setText(str(mask_params['y_tilt']))
+        # set all values without triggering an overlay update for each of them
+        for mask_param_name, mask_param_txt in self._mask_param_txts.items():
+            mask_param_txt.blockSignals(True)
+            mask_param_txt.setText(str(getattr(mask_params, mask_param_name)))
+            self._mask_param_values[mask_param_name] = _text_to_float(mask_param_txt.text())
+            mask_param_txt.blockSignals(False)
+        # the overlay is updated right away so a pending update is no longer needed
+        self._overlay_throttler.stop()
         self._update_mask_overlay()
 
     def _load_mask(self):
@@ -172,11 +166,12 @@ class CreateMaskDlgWidget(QDialog):
                                                    filter='Mask files (*.msk);;All files (*)',
                                                    options=options)
         if mask_file:
-            arena = MonitoredArea()
-            arena.load_rois(mask_file)
-            mask_params, n_rows, n_cols = get_mask_params_from_rois(arena)
-            self._rows_box.setValue(n_rows)
-            self._cols_box.setValue(n_cols)
+            mask_params, n_rows, n_cols = _read_mask_params(mask_file)
+            # the overlay is updated only once, after all values are set
+            for grid_box, grid_value in ((self._rows_box, n_rows), (self._cols_box, n_cols)):
+                grid_box.blockSignals(True)
+                grid_box.setValue(grid_value)
+                grid_box.blockSignals(False)
             self._update_mask_params_values(mask_params)
 
     def _save_mask(self):
@@ -193,49 +188,135 @@ class CreateMaskDlgWidget(QDialog):
             if not mask_fileext:
                 mask_file = mask_file + '.msk'
             # save mask to mask_fileName
-            mask_params = {
-                'x1': float(self.x1_txt.text()),
-                'x_span': float(self.x_span_txt.text()),
-                'x_gap': float(self.x_gap_txt.text()),
-                'x_tilt': float(self.x_tilt_txt.text()),
-
-                'y1': float(self.y1_txt.text()),
-                'y_len': float(self.y_len_txt.text()),
-                'y_sep': float(self.y_sep_txt.text()),
-                'y_tilt': float(self.y_tilt_txt.text()),
-            }
-            n_rows = self._rows_box.value()
-            n_cols = self._cols_box.value()
-            arena = create_mask(n_rows, n_cols, mask_params)
+            arena = self._create_mask()
             arena.save_rois(mask_file)
             self.close() # close if everything went well
 
-    def _update_mask_overlay(self):
-        if self._overlay_check.checkState():
+    def _update_mask_param_value(self, mask_param_name, mask_param_text):
+        self._mask_param_values[mask_param_name] = _text_to_float(mask_param_text)
+        if self._live_preview:
+            self._schedule_mask_overlay_update()
+
+    def _finish_mask_param_edit(self):
+        if not self._live_preview:
+            self._schedule_mask_overlay_update()
+
+    def _toggle_live_preview(self, state):
+        self._live_preview = state == Qt.Checked
+        if self._live_preview:
+            # show the edits made since the last update
+            self._schedule_mask_overlay_update()
+
+    def _schedule_mask_overlay_update(self):
+        if not self._overlay_enabled:
+            # nothing is displayed so there's nothing to update
+            return
+        self._overlay_throttler.throttle()
+
+    def _toggle_mask_overlay(self, state):
+        self._overlay_enabled = state == Qt.Checked
+        if self._overlay_enabled:
             self._draw_mask()
         else:
+            self._overlay_throttler.stop()
             # clear the mask
             self._communication_channels.toggle_mask_signal.emit(False)
 
+    def _update_mask_overlay(self):
+        if self._overlay_enabled:
+            self._draw_mask()
+
     def _draw_mask(self):
-        mask_params = {
-            'x1': _text_to_float(self.x1_txt.text()),
-            'x_span': _text_to_float(self.x_span_txt.text()),
-            'x_gap': _text_to_float(self.x_gap_txt.text()),
-            'x_tilt': _text_to_float(self.x_tilt_txt.text()),
-
-            'y1': _text_to_float(self.y1_txt.text()),
-            'y_len': _text_to_float(self.y_len_txt.text()),
-            'y_sep': _text_to_float(self.y_sep_txt.text()),
-            'y_tilt': _text_to_float(self.y_tilt_txt.text()),
-        }
+        # the mask is sent to the image widget on the next event loop iteration
+        # so that all draw requests made until then result in a single redraw
+        if not self._mask_draw_scheduled:
+            self._mask_draw_scheduled = True
+            QTimer.singleShot(0, self._flush_mask_draw)
+
+    def _flush_mask_draw(self):
+        self._mask_draw_scheduled = False
+        if self._overlay_enabled:
+            arena = self._create_mask()
+            self._communication_channels.monitored_area_rois_signal.emit(arena, self._crossline_choice.currentData())
+
+    def _create_mask(self):
+        """
+        Creates the mask from the current form values. The last created mask is reused
+        if none of the values changed since it was created.
+        :return: the monitored area with the mask ROIs
+        """
         n_rows = self._rows_box.value()
         n_cols = self._cols_box.value()
-        arena = create_mask(n_rows, n_cols, mask_params)
-        self._communication_channels.monitored_area_rois_signal.emit(arena, self._crossline_choice.currentData())
+        mask_params = MaskParams(**self._mask_param_values)
+        mask_key = (mask_params, n_rows, n_cols)
+        if mask_key != self._last_mask_key:
+            self._last_mask = create_mask(n_rows, n_cols, mask_params)
+            self._last_mask_key = mask_key
+        return self._last_mask
+
+
+class SignalThrottler(QObject):
+    """
+    Limits how often the triggered signal is emitted. The first throttle request emits
+    the signal right away and all requests made in the following interval result
+    in a single emit at the end of the interval, so the last request is never lost.
+    """
+    triggered = pyqtSignal()
+
+    def __init__(self, interval, parent=None):
+        super(SignalThrottler, self).__init__(parent)
+        self._pending = False
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._emit_pending)
+
+    def throttle(self):
+        if self._timer.isActive():
+            self._pending = True
+        else:
+            self.triggered.emit()
+            self._timer.start()
+
+    def stop(self):
+        self._pending = False
+        self._timer.stop()
+
+    def _emit_pending(self):
+        if self._pending:
+            self._pending = False
+            self.triggered.emit()
+            self._timer.start()
+
+
+def _read_mask_params(mask_file):
+    """
+    Reads the mask parameters from the given mask file. The parameters are cached and they are only
+    read again if the file's modification time (in nanoseconds) or its size changed since it was last read.
+    :param mask_file: mask file name
+    :return: a tuple with the mask parameters, the number of rows and the number of columns
+    """
+    mask_file_stat = os.stat(mask_file)
+    mask_file_version = (mask_file_stat.st_mtime_ns, mask_file_stat.st_size)
+    cached_mask_file = _mask_files_params.get(mask_file)
+    if cached_mask_file is not None and cached_mask_file[0] == mask_file_version:
+        _mask_files_params.move_to_end(mask_file)
+        return cached_mask_file[1]
+
+    arena = MonitoredArea()
+    arena.load_rois(mask_file)
+    mask_file_params = get_mask_params_from_rois(arena)
+    _mask_files_params[mask_file] = (mask_file_version, mask_file_params)
+    _mask_files_params.move_to_end(mask_file)
+    if len(_mask_files_params) > _MAX_CACHED_MASK_FILES:
+        _mask_files_params.popitem(last=False)
+    return mask_file_params
 
 
 def _text_to_float(s):
+    if not s or s == '-':
+        # the value is still being typed
+        return 0
     try:
         return float(s)
     except ValueError:
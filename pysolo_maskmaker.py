@@ -1,59 +1,43 @@
 #!/usr/bin/env python
 
+import numpy as np
 import sys
-from argparse import ArgumentParser
+from functools import lru_cache
+from typing import NamedTuple
 
 from pysolo_video import MonitoredArea
 
 
+class MaskParams(NamedTuple):
+    """
+    Position and size of the mask ROIs. The ROIs are arranged in a grid - the x values
+    describe how the ROIs are placed along a row and the y values how the rows are placed.
+    """
+    x1: float
+    x_span: float
+    x_gap: float
+    x_tilt: float
+
+    y1: float
+    y_len: float
+    y_sep: float
+    y_tilt: float
+
+
+_MASK_PARAMS_BY_AREA = {
+    'upper_left': MaskParams(x1=191.5, x_span=8, x_gap=3.75, x_tilt=0,
+                             y1=205, y_len=50, y_sep=2, y_tilt=0),
+    'lower_left': MaskParams(x1=194, x_span=8, x_gap=3.75, x_tilt=0,
+                             y1=298, y_len=50, y_sep=2, y_tilt=0),
+    'upper_right': MaskParams(x1=376, x_span=7.75, x_gap=4.2, x_tilt=0,
+                              y1=206, y_len=50, y_sep=2, y_tilt=0),
+    'lower_right': MaskParams(x1=379, x_span=7.7, x_gap=4.1, x_tilt=0,
+                              y1=300, y_len=50, y_sep=2, y_tilt=0),
+}
+
+
 def get_mask_params(area_location):
-    mask_params_by_area_location = {
-        'upper_left': {
-            'x1': 191.5,
-            'x_span': 8,
-            'x_gap': 3.75,
-            'x_tilt': 0,
-
-            'y1': 205,
-            'y_len': 50,
-            'y_sep': 2,
-            'y_tilt': 0,
-        },
-        'lower_left': {
-            'x1': 194,
-            'x_span': 8,
-            'x_gap': 3.75,
-            'x_tilt': 0,
-
-            'y1': 298,
-            'y_len': 50,
-            'y_sep': 2,
-            'y_tilt': 0,
-        },
-        'upper_right': {
-            'x1': 376,
-            'x_span': 7.75,
-            'x_gap': 4.2,
-            'x_tilt': 0,
-
-            'y1': 206,
-            'y_len': 50,
-            'y_sep': 2,
-            'y_tilt': 0,
-        },
-        'lower_right': {
-            'x1': 379,
-            'x_span': 7.7,
-            'x_gap': 4.1,
-            'x_tilt': 0,
-
-            'y1': 300,
-            'y_len': 50,
-            'y_sep': 2,
-            'y_tilt': 0,
-        }
-    }
-    return mask_params_by_area_location[area_location]
+    return _MASK_PARAMS_BY_AREA[area_location]
 
 
 def get_mask_params_from_rois(arena):
@@ -100,70 +84,64 @@ def get_mask_params_from_rois(arena):
 
         prev_roi = roi
 
-    mask_params = {
-        'x1': x1,
-        'x_span': x_span,
-        'x_gap': x_gap,
-        'x_tilt': x_tilt,
-
-        'y1': y1,
-        'y_len': y_len,
-        'y_sep': y_sep,
-        'y_tilt': y_tilt,
-    }
+    mask_params = MaskParams(x1=x1, x_span=x_span, x_gap=x_gap, x_tilt=x_tilt,
+                             y1=y1, y_len=y_len, y_sep=y_sep, y_tilt=y_tilt)
     return mask_params, n_rows, n_cols
 
 
 def create_mask(n_rows, n_cols, mask_params):
-    x1 = mask_params['x1']
-    x_span = mask_params['x_span']
-    x_gap = mask_params['x_gap']
-    x_tilt = mask_params['x_tilt']
+    rois = _create_mask_rois(n_rows, n_cols, *mask_params)
+    arena = MonitoredArea()
+    arena.add_rois(rois)
+    return arena
 
-    y1 = mask_params['y1']
-    y_len = mask_params['y_len']
-    y_sep = mask_params['y_sep']
-    y_tilt = mask_params['y_tilt']
 
-    arena = MonitoredArea()
-    for col in range(0, n_cols):  # x-coordinates change through columns
-        ay = y1 + col * y_tilt  # reset y-coordinate start of col
+@lru_cache(maxsize=64)
+def _create_mask_rois(n_rows, n_cols, x1, x_span, x_gap, x_tilt, y1, y_len, y_sep, y_tilt):
+    """
+    Computes the ROI corners of a mask. The result only depends on the arguments so it is cached
+    and going back to a previous set of mask values does not recompute the ROIs.
+    :return: a tuple with the corners of every ROI
+    """
+    if n_rows <= 0 or n_cols <= 0:
+        return ()
+
+    cols = np.arange(n_cols)
+    if n_rows == 1:
+        # a single row (the most common layout) needs no row offsets
+        ax = x1 + cols * (x_span + x_gap)  # each column starts further in the x direction
+        ay = y1 + cols * y_tilt
         by = ay + y_len
-        cy = by
-        dy = ay
-        if col == 0:
-            ax = x1
-        else:
-            ax = x1 + col * (x_span + x_gap)  # move over in x direction to start next column
-        bx = ax
-        cx = ax + x_span
-        dx = cx
-        for row in range(0, n_rows):  # y-coordinates change through rows
-            arena.add_roi(
-                (
-                    (ax, ay),
-                    (bx, by),
-                    (cx, cy),
-                    (dx, dy)
-                )
-            )
-            ay = by + y_sep  # move down in y direction to start next row
-            by = ay + y_len
-            cy = by
-            dy = ay
-            ax = ax + x_tilt
-            bx = ax
-            cx = ax + x_span
-            dx = cx
-    return arena
+    else:
+        # all ROI corners are computed at once - the cumulative sums add the row offsets
+        # in the same order as stepping through the rows one at a time
+        ax = np.empty((n_cols, n_rows))
+        ax[:, 0] = x1 + cols * (x_span + x_gap)  # each column starts further in the x direction
+        ax[:, 1:] = x_tilt
+        ax = np.cumsum(ax, axis=1)
+        # the y steps alternate between the ROI length and the gap to the next row
+        y_steps = np.empty((n_cols, 2 * n_rows))
+        y_steps[:, 0] = y1 + cols * y_tilt
+        y_steps[:, 1::2] = y_len
+        y_steps[:, 2::2] = y_sep
+        y_steps = np.cumsum(y_steps, axis=1)
+        ay = y_steps[:, 0::2]
+        by = y_steps[:, 1::2]
+    cx = ax + x_span
+    rois_corners = np.stack([ax, ay, ax, by, cx, by, cx, ay], axis=-1).reshape((-1, 4, 2))
+
+    return tuple(tuple(tuple(p) for p in roi) for roi in rois_corners.tolist())
 
 
 def main():
+    # argparse is only needed by the command line tool, not by the modules that import the mask functions
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(usage='prog [options]')
     parser.add_argument('-m', '--mask-file', dest='mask_file', metavar='MASK_FILE',
                         help='The full name of the mask file')
-    parser.add_argument('--rows', dest='rows', default=1, help='The number of rows')
-    parser.add_argument('--cols', dest='cols', default=32, help='The number of cols')
+    parser.add_argument('--rows', dest='rows', type=int, default=1, help='The number of rows')
+    parser.add_argument('--cols', dest='cols', type=int, default=32, help='The number of cols')
     parser.add_argument('-r', '--region', dest='region',
                         required=True,
                         choices=['upper_left', 'lower_left', 'upper_right', 'lower_right'],
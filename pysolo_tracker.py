@@ -2,17 +2,22 @@
 
 import cv2
 import logging.config
+import logging.handlers
+import multiprocessing
 import os
 import sys
 from argparse import ArgumentParser
-
-from multiprocess.pool import Pool
+from concurrent.futures import ProcessPoolExecutor
 
 from pysolo_config import load_config
 from pysolo_video import (process_image_frames, prepare_monitored_areas, MovieFile)
 
 
 _logger = None
+# the config of a tracker worker process - it is sent once when the worker starts, see _init_tracker_process
+_config = None
+# below this number of frames per process the movie is not split between multiple processes
+_MIN_FRAMES_PER_PROCESS = 1000
 
 
 def main():
@@ -51,6 +56,7 @@ def main():
     errors |= set(config.validate())
 
     if len(errors) == 0:
+        tracker_args = None
         if args.nprocesses > 1:
             source = MovieFile(config.get_source(),
                                      start_msecs=args.start_frame_pos * 1000,
@@ -61,14 +67,49 @@ def main():
                 return
             start_frame_pos = int(source.get_start_time_in_seconds())
             end_frame_pos = int(source.get_end_time_in_seconds())
-            frame_interval = int((end_frame_pos - start_frame_pos) / args.nprocesses)
-            tracker_args = [(config, s * 1000, (s + frame_interval) * 1000,
-                             args.gaussian_filter_size, args.gaussian_filter_sigma,
-                             args.nthreads, _get_run_interval(s, s + frame_interval)[1]) for s in
-                            range(start_frame_pos, end_frame_pos, frame_interval)
-                            ]
-            with Pool(args.nprocesses) as p:
-                p.starmap(_run_tracker, tracker_args)
+            fps = source.get_fps()
+            # the movie was only needed to find the interval that is split between the processes
+            source.close()
+            # split the interval in nprocesses parts - the first parts get one more second if it doesn't divide evenly
+            frame_interval, frame_interval_remainder = divmod(end_frame_pos - start_frame_pos, args.nprocesses)
+            if frame_interval <= 0 or frame_interval * fps < _MIN_FRAMES_PER_PROCESS:
+                # starting the worker processes would take longer than tracking the frames in this process
+                _logger.info('Only %d frames per process - run the tracker in a single process' %
+                             (max(frame_interval, 0) * fps))
+            else:
+                tracker_args = []
+                interval_start = start_frame_pos
+                for process_index in range(args.nprocesses):
+                    interval_end = interval_start + frame_interval + (1 if process_index < frame_interval_remainder
+                                                                      else 0)
+                    if process_index < args.nprocesses - 1:
+                        interval_end_msecs = interval_end * 1000
+                    else:
+                        # the last interval also covers the fraction of a second left after the last full second
+                        interval_end_msecs = args.end_frame_pos * 1000
+                    tracker_args.append((interval_start * 1000, interval_end_msecs,
+                                         args.gaussian_filter_size, args.gaussian_filter_sigma,
+                                         args.nthreads, _get_run_interval(interval_start, interval_end)[1]))
+                    interval_start = interval_end
+        if tracker_args:
+            # fork the workers where it is safe so that they start without re-importing all modules;
+            # elsewhere (e.g. macOS) the platform default start method is used
+            mp_context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else None)
+            # the workers send their log records to this process, which writes them with the configured handlers
+            log_queue = mp_context.Queue()
+            log_listener = logging.handlers.QueueListener(log_queue, *_logger.handlers, respect_handler_level=True)
+            with ProcessPoolExecutor(max_workers=args.nprocesses,
+                                     mp_context=mp_context,
+                                     initializer=_init_tracker_process,
+                                     initargs=(log_queue, _logger.level, args.nprocesses, config)) as executor:
+                # submitting the intervals starts the workers - the listener thread is started only after that
+                # so that no thread is running when the workers are forked
+                tracker_results = executor.map(_run_tracker_interval, *zip(*tracker_args))
+                log_listener.start()
+                try:
+                    list(tracker_results)
+                finally:
+                    log_listener.stop()
         else:
             _run_tracker(config, args.start_frame_pos * 1000, args.end_frame_pos * 1000,
                          args.gaussian_filter_size, args.gaussian_filter_sigma, args.nthreads)
@@ -76,29 +117,46 @@ def main():
         _logger.error('Config load error: %r' % errors)
 
 
-def _get_run_interval(start_pos, end_pos):
+def _init_tracker_process(log_queue, log_level, nprocesses, config):
+    global _logger, _config
+    # the worker does not write the log itself - it forwards the records to the parent process
+    _logger = logging.getLogger('tracker')
+    _logger.setLevel(log_level)
+    _logger.propagate = False
+    _logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _config = config
+    # share the cores between the processes instead of letting every process use all of them
+    cv2.setNumThreads(max(1, (os.cpu_count() or 1) // nprocesses))
+    cv2.setUseOptimized(True)
 
-    def start_suffix():
-        if start_pos is None or start_pos <= 0:
-            return False, '0'
-        else:
-            return True, '{}'.format(start_pos)
 
-    def end_suffix():
-        if end_pos is None or end_pos < 0:
-            return False, 'end'
-        else:
-            return True, '{}'.format(end_pos)
+def _get_run_interval(start_pos, end_pos):
+    """
+    :return: a flag that is set if the run is limited to a subinterval of the movie and the interval as a string
+    """
+    start_defined = start_pos is not None and start_pos > 0
+    end_defined = end_pos is not None and end_pos >= 0
+    start_suffix = f'{start_pos}' if start_defined else '0'
+    end_suffix = f'{end_pos}' if end_defined else 'end'
+    return start_defined or end_defined, f'{start_suffix}-{end_suffix}'
+
 
-    start = start_suffix()
-    end = end_suffix()
-    return start[0] or end[0], start[1] + '-' + end[1]
+def _run_tracker_interval(start_pos_msecs, end_pos_msecs, gaussian_filter_size, gaussian_filter_sigma, nthreads,
+                          results_suffix):
+    # runs in a worker process so the config is the one received when the worker started
+    _run_tracker(_config, start_pos_msecs, end_pos_msecs, gaussian_filter_size, gaussian_filter_sigma, nthreads,
+                 results_suffix=results_suffix)
 
 
 def _run_tracker(config, start_pos_msecs, end_pos_msecs, gaussian_filter_size, gaussian_filter_sigma, nthreads,
                  results_suffix=''):
-    subinterval_defined, run_interval = _get_run_interval(start_pos_msecs / 1000, end_pos_msecs / 1000)
-    _logger.info('Run tracker for frames between {}'.format(run_interval))
+    if results_suffix:
+        # the interval was already formatted by the caller
+        run_interval = output_suffix = results_suffix
+    else:
+        subinterval_defined, run_interval = _get_run_interval(start_pos_msecs / 1000, end_pos_msecs / 1000)
+        output_suffix = run_interval if subinterval_defined else ''
+    _logger.info('Run tracker for frames between %s' % run_interval)
 
     image_source = MovieFile(config.get_source(),
                              start_msecs=start_pos_msecs,
@@ -107,10 +165,6 @@ def _run_tracker(config, start_pos_msecs, end_pos_msecs, gaussian_filter_size, g
     if not image_source.is_opened():
         _logger.error('Error opening %s' % config.get_source())
     else:
-        if subinterval_defined:
-            output_suffix = results_suffix or run_interval
-        else:
-            output_suffix = results_suffix
         monitored_areas = prepare_monitored_areas(config,
                                                   fps=image_source.get_fps(),
                                                   results_suffix=output_suffix)
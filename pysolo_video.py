@@ -4,6 +4,8 @@ import logging
 import numpy as np
 import os
 import pickle
+import queue
+import threading
 
 from datetime import datetime, timedelta
 from enum import Enum
@@ -13,6 +15,10 @@ from os.path import dirname, exists
 
 
 _logger = logging.getLogger('tracker')
+# closing with a 5x5 rectangle is the same as 2 dilations followed by 2 erosions with the default 3x3 kernel
+_FLY_CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+# mask files saved with np.savez are zip archives - older mask files are pickled
+_NPZ_MAGIC = b'PK'
 
 
 class TrackingType(Enum):
@@ -60,6 +66,8 @@ class MonitoredArea():
         self._sleep_deprivation_flag = sleep_deprivation_flag
         self.ROIS = []  # regions of interest
         self.rois_background = []
+        # per ROI images reused by the tracker for every frame - see _get_roi_work_images
+        self.rois_work_images = []
         self._beams = []  # beams: absolute coordinates
         self._points_to_track = []
         self._tracking_data_buffer_size = tracking_data_buffer_size if tracking_data_buffer_size > 0 else 1
@@ -71,6 +79,8 @@ class MonitoredArea():
         self._roi_filter = None
         self._extend = extend
         self._result_suffix = results_suffix
+        # cached geometry of the ROIs - see get_trackable_rois_polys and get_rois_rects
+        self._rois_geometry = {}
 
         # shape ( rois, (x, y) ) - contains the coordinates of the current frame per ROI
         self._current_frame_fly_coord = np.zeros((1, 2), dtype=np.uint32)
@@ -83,7 +93,6 @@ class MonitoredArea():
         # index to the aggregated frames buffer - the reason for this is that if the number of aggregated frames is
         # too large these will drift apart
         self._aggregated_frames_buffer_index = 0
-        self._first_position = (0, 0)
 
     def get_results_suffix(self):
         return self._result_suffix
@@ -95,6 +104,7 @@ class MonitoredArea():
         :return:
         """
         self._roi_filter = trackable_rois
+        self._rois_geometry = {}
 
     def is_roi_trackable(self, roi):
         return self._roi_filter is None or self._roi_filter == [] or roi in self._roi_filter
@@ -103,28 +113,17 @@ class MonitoredArea():
         self._lineno = 0
         self.output_filename = filename
 
-    def add_fly_coords(self, roi_index, coords):
+    def update_fly_coords(self, roi_indexes, fly_coords):
         """
-        Add the provided coordinates to the existing list
-        fly_index   int     the fly index number in the arena
-        coords      (x,y)    the coordinates to add
-        Called for every fly moving in every frame
+        Sets the fly coordinates of the given ROIs for the current frame.
+        :param roi_indexes: array with the indexes of the ROIs
+        :param fly_coords: (n, 2) array with the new fly coordinates in each ROI - NaN if no fly was detected
+        :return: the current fly coordinates of the given ROIs
         """
-        previous_position = tuple(self._current_frame_fly_coord[roi_index])
-        is_first_movement = (previous_position == self._first_position)
-        # coords is None if no blob was detected
-        fly_coords = previous_position if coords is None else coords
-
-        distance = self._distance(previous_position, fly_coords)
-        if distance == 0:
-            # leave the position unchanged if the distance from the previous position is either too small or too big
-            fly_coords = previous_position
-
-        # Does a running average for the coordinates of the fly at each frame to _fly_coord_buffer
-        # This way the shape of _fly_coord_buffer is always (n, (x,y)) and once a second we just have to add the (x,y)
-        # values to _fly_period_end_coords, whose shape is (n, 60, (x,y))
-        self._current_frame_fly_coord[roi_index] = fly_coords
-        return self._current_frame_fly_coord[roi_index], distance
+        # the previous position is kept where no fly was detected
+        detected = ~np.isnan(fly_coords[:, 0])
+        self._current_frame_fly_coord[roi_indexes[detected]] = fly_coords[detected]
+        return self._current_frame_fly_coord[roi_indexes]
 
     def _distance(self, p1, p2):
         """
@@ -144,6 +143,97 @@ class MonitoredArea():
         self.ROIS.append(roi)
         self._points_to_track.append(n_flies)
         self._beams.append(self.get_midline(roi))
+        self._rois_geometry = {}
+
+    def add_rois(self, rois, n_flies=1):
+        """
+        Add all given ROIs at once - same as calling add_roi for each ROI
+        :param rois: sequence of ROIs
+        :param n_flies: number of flies to track in each ROI
+        :return:
+        """
+        self.ROIS.extend(rois)
+        self._points_to_track.extend([n_flies] * len(rois))
+        self._beams.extend([self.get_midline(roi) for roi in rois])
+        self._rois_geometry = {}
+
+    def get_trackable_rois_polys(self, scale=(1, 1)):
+        """
+        Returns the polygons of all trackable ROIs as an int32 array of shape (n_rois, 4, 2)
+        that can be passed directly to cv2.polylines. The array is computed only once per scale.
+        The polygon of a ROI is its bounding rect starting with the lower left corner.
+        """
+        geometry_key = ('polys', tuple(scale))
+        polys = self._rois_geometry.get(geometry_key)
+        if polys is None:
+            rois_min, rois_max = self._trackable_rois_bounds()
+            lx, uy = rois_min[:, 0], rois_min[:, 1]
+            rx, ly = rois_max[:, 0], rois_max[:, 1]
+            polys = np.stack([np.stack([lx, ly], axis=1),
+                              np.stack([lx, uy], axis=1),
+                              np.stack([rx, uy], axis=1),
+                              np.stack([rx, ly], axis=1)], axis=1)
+            polys = (polys * np.asarray(scale, dtype=np.float64)).astype(np.int32)
+            self._rois_geometry[geometry_key] = polys
+        return polys
+
+    def get_trackable_rois_midlines(self, scale=(1, 1), midline_type=None):
+        """
+        Returns the midlines of all trackable ROIs as an int32 array of shape (n_rois, 2, 2)
+        that can be passed directly to cv2.polylines. The array is computed only once per scale and midline type.
+        The result is the same as applying get_midline(roi, scale, conv=int, midline_type) to every trackable ROI.
+        """
+        geometry_key = ('midlines', tuple(scale), midline_type)
+        midlines = self._rois_geometry.get(geometry_key)
+        if midlines is None:
+            rois_min, rois_max = self._trackable_rois_bounds()
+            # get_midline works with the unscaled integer rect
+            x1, y1 = np.trunc(rois_min[:, 0]), np.trunc(rois_min[:, 1])
+            x2, y2 = np.trunc(rois_max[:, 0]), np.trunc(rois_max[:, 1])
+            if midline_type == CrossingBeamType.horizontal:
+                horizontal_beams = np.ones(x1.shape, dtype=bool)
+            elif midline_type == CrossingBeamType.vertical:
+                horizontal_beams = np.zeros(x1.shape, dtype=bool)
+            else:
+                horizontal_beams = np.abs(y2 - y1) >= np.abs(x2 - x1)
+            ym = y1 + (y2 - y1) / 2
+            xm = x1 + (x2 - x1) / 2
+            horizontal_midlines = np.stack([np.stack([x1, ym], axis=1), np.stack([x2, ym], axis=1)], axis=1)
+            vertical_midlines = np.stack([np.stack([xm, y1], axis=1), np.stack([xm, y2], axis=1)], axis=1)
+            midlines = np.where(horizontal_beams[:, np.newaxis, np.newaxis], horizontal_midlines, vertical_midlines)
+            midlines = (midlines * np.asarray(scale, dtype=np.float64)).astype(np.int32)
+            self._rois_geometry[geometry_key] = midlines
+        return midlines
+
+    def get_rois_rects(self, scale=(1, 1)):
+        """
+        Returns the rects of all ROIs indexed by the ROI index. The rects are computed only once per scale
+        and the result is the same as applying roi_to_rect to every ROI.
+        """
+        geometry_key = ('rects', tuple(scale))
+        rects = self._rois_geometry.get(geometry_key)
+        if rects is None:
+            rois_min, rois_max = self._rois_bounds()
+            scale_arr = np.asarray(scale, dtype=np.float64)
+            rois_rects = np.stack([rois_min * scale_arr, rois_max * scale_arr], axis=1).astype(np.int64)
+            rects = [((lx, uy), (rx, ly)) for (lx, uy), (rx, ly) in rois_rects.tolist()]
+            self._rois_geometry[geometry_key] = rects
+        return rects
+
+    def _trackable_rois_bounds(self):
+        """
+        Returns the min and the max (x, y) corners of all trackable ROIs as two (n_rois, 2) float arrays
+        """
+        return self._rois_bounds(trackable_only=True)
+
+    def _rois_bounds(self, trackable_only=False):
+        """
+        Returns the min and the max (x, y) corners of the ROIs as two (n_rois, 2) float arrays
+        """
+        rois = np.array([roi for roi_index, roi in enumerate(self.ROIS)
+                         if not trackable_only or self.is_roi_trackable(roi_index)],
+                        dtype=np.float64).reshape((-1, 4, 2))
+        return rois.min(axis=1), rois.max(axis=1)
 
     def roi_to_rect(self, roi, scale=(1, 1)):
         """
@@ -160,24 +250,6 @@ class MonitoredArea():
             (int(rx * scale[0]), int(ly * scale[1]))
         )
 
-    def roi_to_poly(self, roi, scale=(1, 1)):
-        """
-        Converts a ROI (a tuple of four points coordinates) into
-        a Rect (a tuple of two points coordinates)
-        """
-        (x1, y1), (x2, y2), (x3, y3), (x4, y4) = roi
-        lx = min([x1, x2, x3, x4])
-        rx = max([x1, x2, x3, x4])
-        uy = min([y1, y2, y3, y4])
-        ly = max([y1, y2, y3, y4])
-
-        return [
-            [int(lx * scale[0]), int(ly * scale[1])],
-            [int(lx * scale[0]), int(uy * scale[1])],
-            [int(rx * scale[0]), int(uy * scale[1])],
-            [int(rx * scale[0]), int(ly * scale[1])]
-        ]
-
     def get_midline(self, roi, scale=(1, 1), conv=None, midline_type=None):
         """
         Return the position of each ROI's midline
@@ -206,25 +278,40 @@ class MonitoredArea():
                 return (xm * scale[0], y1 * scale[1]), (xm * scale[0], y2 * scale[1])
 
     def save_rois(self, filename):
+        """
+        Save the ROIs as NumPy arrays. The file is written through a file object
+        so that numpy does not append the .npz extension to the mask file name.
+        """
         with open(filename, 'wb') as cf:
-            pickle.dump(self.ROIS, cf)
-            pickle.dump(self._points_to_track, cf)
+            np.savez(cf,
+                     rois=np.asarray(self.ROIS, dtype=np.float64).reshape((-1, 4, 2)),
+                     points_to_track=np.asarray(self._points_to_track, dtype=np.int32))
 
     def load_rois(self, filename):
         """
-        Load the crop data from the specified filename
+        Load the crop data from the specified filename. Masks saved as NumPy arrays and
+        masks saved with pickle by older versions are both supported.
         :param filename: name of the file to load the cropped region from
         :return:
         """
         self._mask_file = filename
         with open(filename, 'rb') as cf:
-            self.ROIS = pickle.load(cf)
-            self._points_to_track = pickle.load(cf)
+            if cf.read(len(_NPZ_MAGIC)) == _NPZ_MAGIC:
+                cf.seek(0)
+                with np.load(cf) as rois_data:
+                    self.ROIS = [tuple(tuple(p) for p in roi) for roi in rois_data['rois'].tolist()]
+                    self._points_to_track = rois_data['points_to_track'].tolist()
+            else:
+                cf.seek(0)
+                self.ROIS = pickle.load(cf)
+                self._points_to_track = pickle.load(cf)
         self._reset_data_buffers()
+        self._rois_geometry = {}
         for roi_index, roi in enumerate(self.ROIS):
-            _logger.debug('ROI: %d: %r' % (roi_index + 1, roi))
+            _logger.debug('ROI: %d: %r', roi_index + 1, roi)
             self._beams.append(self.get_midline(roi))
             self.rois_background.append(None)
+            self.rois_work_images.append(None)
 
     def _reset_data_buffers(self):
         self._reset_current_frame_buffer()
@@ -395,30 +482,27 @@ class MonitoredArea():
         # the values.shape is (nframes, nrois)),
         values = np.zeros((len(self.ROIS)), dtype=np.uint32)
         if nframes > 0:
-            roi_index = 0
-            for fd, md in zip(self._aggregated_frames_fly_coord, self._relative_beams()):
-                if self.is_roi_trackable(roi_index):
-                    (mx1, my1), (mx2, my2) = md
-                    horizontal_beam = (my1 == my2)
-
-                    fs = np.roll(fd, -1, 0)  # coordinates shifted to the following frame
-
-                    x = fd[:self._aggregated_frames_buffer_index, 0]
-                    y = fd[:self._aggregated_frames_buffer_index, 1]
-                    x1 = fs[:self._aggregated_frames_buffer_index, 0]
-                    y1 = fs[:self._aggregated_frames_buffer_index, 1]
-
-                    if horizontal_beam:
-                        crosses = (y < my1) * (y1 >= my1) + (y > my1) * (y1 <= my1)
-                    else:
-                        crosses = (x < mx1) * (x1 >= mx1) + (x > mx1) * (x1 <= mx1)
-                    # we sum nframes to eliminate duplication
-                    values[roi_index] = crosses[:nframes].sum()
-                else:
-                    # the region is not tracked
-                    values[roi_index] = 0
-
-                roi_index += 1
+            # all ROIs are processed at once - the coordinates buffer already has one row per ROI
+            beams = self._relative_beams()
+            mx1 = beams[:, 0, 0, np.newaxis]
+            my1 = beams[:, 0, 1, np.newaxis]
+            horizontal_beams = beams[:, 0, 1] == beams[:, 1, 1]
+
+            fs = np.roll(self._aggregated_frames_fly_coord, -1, axis=1)  # coordinates shifted to the following frame
+
+            x = self._aggregated_frames_fly_coord[:, :nframes, 0]
+            y = self._aggregated_frames_fly_coord[:, :nframes, 1]
+            x1 = fs[:, :nframes, 0]
+            y1 = fs[:, :nframes, 1]
+
+            horizontal_crosses = (y < my1) * (y1 >= my1) + (y > my1) * (y1 <= my1)
+            vertical_crosses = (x < mx1) * (x1 >= mx1) + (x > mx1) * (x1 <= mx1)
+            # we sum nframes to eliminate duplication
+            crosses = np.where(horizontal_beams[:, np.newaxis], horizontal_crosses, vertical_crosses).sum(axis=1)
+            trackable_rois = np.array([self.is_roi_trackable(roi_index) for roi_index in range(len(self.ROIS))],
+                                      dtype=bool)
+            # the regions that are not tracked have no crossings
+            values[trackable_rois] = crosses[trackable_rois]
 
             self._shift_data_window(nframes)
 
@@ -426,20 +510,17 @@ class MonitoredArea():
 
     def _relative_beams(self, scale=None):
         """
-        Return the coordinates of the beam
-        relative to the ROI to which they belong
+        Return the coordinates of the beam relative to the ROI to which they belong
+        as a (n_rois, 2, 2) float array. The beams are computed only once per scale.
         """
         scalef = (1, 1) if scale is None else scale
-        beams = []
-        for roi, beam in zip(self.ROIS, self._beams):
-            rx, ry = self.roi_to_rect(roi)[0]
-            (bx0, by0), (bx1, by1) = beam
-            beams.append(
-                (
-                    ((bx0 - rx) * scalef[0], (by0 - ry) * scalef[1]),
-                    ((bx1 - rx) * scalef[0], (by1 - ry) * scalef[1])
-                )
-            )
+        geometry_key = ('relative_beams', tuple(scalef))
+        beams = self._rois_geometry.get(geometry_key)
+        if beams is None:
+            rois_origins = np.array([rect[0] for rect in self.get_rois_rects()], dtype=np.float64).reshape((-1, 1, 2))
+            beams = np.array(self._beams[:len(self.ROIS)], dtype=np.float64).reshape((-1, 2, 2))
+            beams = (beams - rois_origins) * np.asarray(scalef, dtype=np.float64)
+            self._rois_geometry[geometry_key] = beams
         return beams
 
     def _calculate_position(self, resolution=1):
@@ -757,6 +838,9 @@ def estimate_background(image_source,
 
 
 def prepare_monitored_areas(config, fps=1, results_suffix=''):
+    # the settings shared by all monitored areas are only read once
+    acq_time = config.get_acq_time()
+    output_dirname = config.get_data_folder()
 
     def create_monitored_area(configured_area_index, configured_area):
         aggregated_frames = configured_area.get_aggregation_interval_in_frames(fps)
@@ -766,7 +850,7 @@ def prepare_monitored_areas(config, fps=1, results_suffix=''):
                            fps=fps,
                            aggregated_frames=aggregated_frames,
                            aggregated_frames_size=aggregated_frames_size,
-                           acq_time=config.get_acq_time(),
+                           acq_time=acq_time,
                            extend=configured_area.get_extend_flag(),
                            results_suffix=results_suffix)
         ma.set_roi_filter(configured_area.get_tracked_rois_filter())
@@ -788,7 +872,6 @@ def prepare_monitored_areas(config, fps=1, results_suffix=''):
             ma.get_track_type_desc(),
             ma_results_suffix
         )
-        output_dirname = config.get_data_folder()
         fulloutput_pattern = os.path.join(output_dirname, output_pattern)
 
         for monitor_index in range(0, n_monitors):
@@ -812,48 +895,72 @@ def process_image_frames(image_source, monitored_areas,
                          moving_alpha=0.1,
                          cancel_callback=None,
                          frame_callback=None,
-                         mp_pool_size=1):
+                         mp_pool_size=1,
+                         prefetch_size=8):
+    # prefetch_size is the number of frames decoded ahead while the current frame is tracked - 0 to not read ahead
     image_scalef = image_source.get_scale()
-    pool = ThreadPool(mp_pool_size)
-
-    results = None
-    for frame_image, frame_index, frame_time_pos in _next_image_frame(image_source, cancel_callback=cancel_callback):
-        _logger.debug('Process frame %d(frame time: %rs)' % (frame_index, frame_time_pos))
-
-        # there is an option to use the thread pool but it appears that it really doesn't help much
-        # on the contrary - using the thread pool makes the processing slower.
-        if mp_pool_size <= 1:
-            results = list(itertools.starmap(partial(_process_roi,
-                                                     frame_image,
-                                                     gaussian_filter_size=gaussian_filter_size,
-                                                     gaussian_sigma=gaussian_sigma,
-                                                     moving_alpha=moving_alpha,
-                                                     scalef=image_scalef),
-                                             _next_monitored_area_roi(monitored_areas)))
+    # the ROIs are only processed in a thread pool if more than one thread is requested
+    pool = ThreadPool(mp_pool_size) if mp_pool_size > 1 else None
+    try:
+        if prefetch_size > 0:
+            image_frames = _ImageFramesPrefetcher(image_source, prefetch_size, cancel_callback=cancel_callback)
+            frame_time_source = image_frames
         else:
-            results = pool.starmap(partial(_process_roi,
-                                           frame_image,
-                                           gaussian_filter_size=gaussian_filter_size,
-                                           gaussian_sigma=gaussian_sigma,
-                                           moving_alpha=moving_alpha,
-                                           scalef=image_scalef),
-                                   _next_monitored_area_roi(monitored_areas))
-
-        if frame_callback:
-            frame_callback(frame_index, frame_time_pos, frame_image, [(r[0][0] * image_scalef[0], r[0][1] * image_scalef[1]) for r in results if r])
-
-        def update_monitored_area_activity(monitored_area):
-            monitored_area.update_frame_activity(frame_time_pos)
-
-        list(map(update_monitored_area_activity, monitored_areas))
-
-    if results is not None and frame_callback:
-        frame_callback(frame_index,
-                       frame_time_pos,
-                       frame_image,
-                       [(r[0][0] * image_scalef[0], r[0][1] * image_scalef[1]) for r in results])
-
-    frame_time_pos = image_source.get_current_frame_time_in_seconds()
+            image_frames = _next_image_frame(image_source, cancel_callback=cancel_callback)
+            frame_time_source = image_source
+
+        # the trackable ROIs do not change during the run so they are only listed once
+        trackable_rois = list(_next_monitored_area_roi(monitored_areas))
+        areas_rois = _group_rois_by_monitored_area(trackable_rois)
+        # position of every trackable ROI in the image
+        rois_origins = np.array([monitored_area.get_rois_rects(image_scalef)[roi_index][0]
+                                 for monitored_area, roi, roi_index in trackable_rois],
+                                dtype=np.float64).reshape((-1, 2)) / np.asarray(image_scalef, dtype=np.float64)
+        fly_coords = None
+        for frame_image, frame_index, frame_time_pos in image_frames:
+            # the message is only formatted if debug logging is enabled
+            _logger.debug('Process frame %d(frame time: %rs)', frame_index, frame_time_pos)
+
+            # there is an option to use the thread pool but it appears that it really doesn't help much
+            # on the contrary - using the thread pool makes the processing slower.
+            if pool is None:
+                results = list(itertools.starmap(partial(_process_roi,
+                                                         frame_image,
+                                                         gaussian_filter_size=gaussian_filter_size,
+                                                         gaussian_sigma=gaussian_sigma,
+                                                         moving_alpha=moving_alpha,
+                                                         scalef=image_scalef),
+                                                 trackable_rois))
+            else:
+                results = pool.starmap(partial(_process_roi,
+                                               frame_image,
+                                               gaussian_filter_size=gaussian_filter_size,
+                                               gaussian_sigma=gaussian_sigma,
+                                               moving_alpha=moving_alpha,
+                                               scalef=image_scalef),
+                                       trackable_rois)
+
+            fly_coords = _update_fly_coords(areas_rois, results) + rois_origins
+
+            if frame_callback:
+                frame_callback(frame_index, frame_time_pos, frame_image, fly_coords * image_scalef)
+
+            def update_monitored_area_activity(monitored_area):
+                monitored_area.update_frame_activity(frame_time_pos)
+
+            list(map(update_monitored_area_activity, monitored_areas))
+
+        if fly_coords is not None and frame_callback:
+            frame_callback(frame_index,
+                           frame_time_pos,
+                           frame_image,
+                           fly_coords * image_scalef)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    frame_time_pos = frame_time_source.get_current_frame_time_in_seconds()
     _logger.info('Aggregate the remaining frames - frame time: %ds' % frame_time_pos)
     # write the remaining activity that is still in memory
     for monitored_area in monitored_areas:
@@ -875,6 +982,84 @@ def _next_image_frame(image_source, cancel_callback=None):
         yield (frame_image, frame_index, frame_time_pos)
 
 
+class _ImageFramesPrefetcher():
+    """
+    Iterates over the same frames as _next_image_frame but the frames are read and decoded
+    in a separate thread so that reading the next frames overlaps with processing the current one.
+    """
+
+    def __init__(self, image_source, prefetch_size, cancel_callback=None):
+        """
+        :param image_source: image source
+        :param prefetch_size: how many frames to read ahead
+        :param cancel_callback: the frames are no longer read once this returns False
+        """
+        self._image_source = image_source
+        self._prefetch_size = prefetch_size
+        self._cancel_callback = cancel_callback
+        # time of the first frame that was read but not processed
+        self._next_frame_time_pos = None
+        # error raised by the reader thread - it is raised again to the consumer after the last read frame
+        self._read_error = None
+
+    def get_current_frame_time_in_seconds(self):
+        """
+        :return: the frame time right after the last processed frame - same as the image source time
+        when the frames are read without prefetching
+        """
+        if self._next_frame_time_pos is not None:
+            return self._next_frame_time_pos
+        return self._image_source.get_current_frame_time_in_seconds()
+
+    def __iter__(self):
+        image_frames_queue = queue.Queue(maxsize=self._prefetch_size)
+        stop_reading = threading.Event()
+        unqueued_frames = []
+
+        def enqueue(item):
+            # wait for room in the queue but give up as soon as the consumer stopped
+            while not stop_reading.is_set():
+                try:
+                    image_frames_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_image_frames():
+            try:
+                for image_frame in _next_image_frame(self._image_source):
+                    if not enqueue(image_frame):
+                        unqueued_frames.append(image_frame)
+                        break
+            except Exception as e:
+                # the error must not be mistaken for the end of the movie
+                self._read_error = e
+            finally:
+                # the end of the frames is marked with None
+                enqueue(None)
+
+        reader = threading.Thread(target=read_image_frames, name='image-frames-reader', daemon=True)
+        reader.start()
+        not_cancelled = self._cancel_callback or _always_true
+        try:
+            while not_cancelled():
+                image_frame = image_frames_queue.get()
+                if image_frame is None:
+                    if self._read_error is not None:
+                        raise self._read_error
+                    break
+                yield image_frame
+        finally:
+            # the image source must not be used by the reader once the caller is done with the frames
+            stop_reading.set()
+            reader.join()
+            # the frames read ahead are dropped so the current time is the time of the first of them
+            read_ahead_frames = [f for f in image_frames_queue.queue if f is not None] + unqueued_frames
+            if read_ahead_frames:
+                self._next_frame_time_pos = read_ahead_frames[0][2]
+
+
 def _always_true():
     return True
 
@@ -886,19 +1071,71 @@ def _next_monitored_area_roi(monitored_areas):
                 yield (monitored_area, roi, roi_index)
 
 
+def _group_rois_by_monitored_area(trackable_rois):
+    """
+    Groups the trackable ROIs by their monitored area.
+    :param trackable_rois: list of (monitored_area, roi, roi_index) tuples as returned by _next_monitored_area_roi
+    :return: a list with the monitored area, the indexes of its ROIs and
+             the slice of the trackable ROIs that belong to it
+    """
+    areas_rois = []
+    start = 0
+    for monitored_area, area_rois in itertools.groupby(trackable_rois, key=lambda roi: roi[0]):
+        roi_indexes = np.array([roi_index for _, _, roi_index in area_rois], dtype=np.intp)
+        areas_rois.append((monitored_area, roi_indexes, slice(start, start + len(roi_indexes))))
+        start += len(roi_indexes)
+    return areas_rois
+
+
+def _update_fly_coords(areas_rois, rois_fly_coords):
+    """
+    Stores the fly coordinates found in the current frame with a single update per monitored area.
+    :param areas_rois: the trackable ROIs grouped by monitored area - see _group_rois_by_monitored_area
+    :param rois_fly_coords: the coordinates found in every trackable ROI or None if no fly was found
+    :return: a (n_rois, 2) array with the current fly coordinates relative to their ROI
+    """
+    fly_coords = np.array([(np.nan, np.nan) if coords is None else coords for coords in rois_fly_coords],
+                          dtype=np.float64).reshape((-1, 2))
+    for monitored_area, roi_indexes, rois_slice in areas_rois:
+        fly_coords[rois_slice] = monitored_area.update_fly_coords(roi_indexes, fly_coords[rois_slice])
+    return fly_coords
+
+
+def _get_roi_work_images(monitored_area, roi_index, image_roi):
+    """
+    Returns the images in which the tracker stores the intermediate results for the given ROI.
+    They are allocated for the first frame and then reused for all the following frames.
+    :return: a tuple with the filtered ROI, the background, the background difference,
+             its grayscale version and the binary image
+    """
+    roi_work_images = monitored_area.rois_work_images[roi_index]
+    if roi_work_images is None or roi_work_images[0].shape != image_roi.shape:
+        gray_shape = image_roi.shape[:2]
+        roi_work_images = (np.empty_like(image_roi),
+                           np.empty_like(image_roi),
+                           np.empty_like(image_roi),
+                           np.empty(gray_shape, dtype=np.uint8),
+                           np.empty(gray_shape, dtype=np.uint8))
+        monitored_area.rois_work_images[roi_index] = roi_work_images
+    return roi_work_images
+
+
 def _process_roi(image, monitored_area, roi, roi_index,
                  gaussian_filter_size=(3, 3),
                  gaussian_sigma=0,
                  moving_alpha=0.1,
                  scalef=(1, 1)):
-    (roi_min_x, roi_min_y), (roi_max_x, roi_max_y) = monitored_area.roi_to_rect(roi, scalef)
+    (roi_min_x, roi_min_y), (roi_max_x, roi_max_y) = monitored_area.get_rois_rects(scalef)[roi_index]
 
     image_roi = image[roi_min_y:roi_max_y, roi_min_x:roi_max_x]
 
+    filtered_roi, roi_background, roi_background_diff, roi_gray_diff, roi_binary = _get_roi_work_images(
+        monitored_area, roi_index, image_roi)
+
     if gaussian_filter_size[0] == 0:
-        filtered_roi =  image_roi
+        filtered_roi = image_roi
     else:
-        filtered_roi =  cv2.GaussianBlur(image_roi, gaussian_filter_size, gaussian_sigma)
+        cv2.GaussianBlur(image_roi, gaussian_filter_size, gaussian_sigma, dst=filtered_roi)
 
     roi_average = monitored_area.rois_background[roi_index]
     if roi_average is None:
@@ -907,15 +1144,17 @@ def _process_roi(image, monitored_area, roi, roi_index,
         roi_average = cv2.accumulateWeighted(filtered_roi, roi_average, alpha=moving_alpha)
 
     monitored_area.rois_background[roi_index] = roi_average
-    roi_background = cv2.convertScaleAbs(roi_average)
+    cv2.convertScaleAbs(roi_average, dst=roi_background)
 
     # subtract the background - but instead of subtracting the background from the image
     # we subtract the image from the background because the background has a higher intensity than the fly
-    roi_background_diff = cv2.subtract(roi_background, filtered_roi)
-    roi_gray_diff = cv2.cvtColor(roi_background_diff, cv2.COLOR_BGR2GRAY)
-    _, roi_binary = cv2.threshold(roi_gray_diff, 40, 255, cv2.THRESH_BINARY)
-    roi_binary = cv2.dilate(roi_binary, None, iterations=2)
-    roi_binary = cv2.erode(roi_binary, None, iterations=2)
+    cv2.subtract(roi_background, filtered_roi, dst=roi_background_diff)
+    cv2.cvtColor(roi_background_diff, cv2.COLOR_BGR2GRAY, dst=roi_gray_diff)
+    cv2.threshold(roi_gray_diff, 40, 255, cv2.THRESH_BINARY, dst=roi_binary)
+    if cv2.countNonZero(roi_binary) == 0:
+        # nothing stands out from the background so there is no fly to look for
+        return None
+    cv2.morphologyEx(roi_binary, cv2.MORPH_CLOSE, _FLY_CLOSE_KERNEL, dst=roi_binary)
 
     fly_cnts, _ = cv2.findContours(roi_binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -942,9 +1181,7 @@ def _process_roi(image, monitored_area, roi, roi_index,
                 fly_coords = coords
                 fly_area = area
 
-    rel_fly_coord, distance = monitored_area.add_fly_coords(roi_index,
-                                                            (fly_coords[0] / scalef[0],
-                                                             fly_coords[1] / scalef[1]) if fly_coords is not None
-                                                            else None)
-    return (rel_fly_coord[0] + roi_min_x / scalef[0],
-            rel_fly_coord[1] + roi_min_y / scalef[1]), rel_fly_coord, distance
+    # the coordinates are stored for all ROIs at once - see _update_fly_coords
+    if fly_coords is None:
+        return None
+    return fly_coords[0] / scalef[0], fly_coords[1] / scalef[1]
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from pysolo_video import ImageSource, _ImageFramesPrefetcher, _next_image_frame
+
+
+class _FailingImageSource(ImageSource):
+    """
+    Image source that returns a few frames and then fails to read the next one
+    """
+
+    def __init__(self, n_frames):
+        super(_FailingImageSource, self).__init__()
+        self._n_frames = n_frames
+        self._current_frame = 0
+
+    def get_current_frame_time_in_seconds(self):
+        return self._current_frame / 10
+
+    def get_image(self):
+        if self._current_frame >= self._n_frames:
+            raise IOError('Error decoding frame %d' % self._current_frame)
+        frame_index = self._current_frame
+        self._current_frame += 1
+        return True, frame_index, np.full((2, 2), frame_index, dtype=np.uint8)
+
+
+def test_prefetched_frames_read_error_is_raised():
+    image_frames = _ImageFramesPrefetcher(_FailingImageSource(5), 2)
+    frame_indexes = []
+    with pytest.raises(IOError):
+        for _, frame_index, _ in image_frames:
+            frame_indexes.append(frame_index)
+    # all frames read before the error are still processed
+    assert frame_indexes == list(range(5))
+
+
+def test_prefetched_frames_same_as_not_prefetched():
+    class _ImageSource(_FailingImageSource):
+        def get_image(self):
+            if self._current_frame >= self._n_frames:
+                return False, -1, None
+            return super(_ImageSource, self).get_image()
+
+    expected_frames = [(frame_index, frame_time) for _, frame_index, frame_time in _next_image_frame(_ImageSource(20))]
+    image_frames = _ImageFramesPrefetcher(_ImageSource(20), 4)
+    assert [(frame_index, frame_time) for _, frame_index, frame_time in image_frames] == expected_frames
+    assert image_frames.get_current_frame_time_in_seconds() == 2